@@ -0,0 +1,8 @@
+# SPDX-FileCopyrightText: 2024-present Tom Vander Aa <tom.vanderaa@gmail.com>
+#
+# SPDX-License-Identifier: MIT
+
+from .ipwatch import main
+
+if __name__ == "__main__":
+    main()
@@ -28,31 +28,127 @@ as published by Sam Hocevar. See http://www.wtfpl.net/ for more details.
 Updated by Sean Begley for the ipwatch project (https://github.com/begleysm/ipwatch/)
 """
 
+import atexit
+import functools
 import http.cookiejar as cjar
-import importlib.resources
 import json
 import os
 import random
 import re
 import socket
 import ssl
+import time
 import urllib.request as urllib
+import concurrent.futures
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta
 
-import platformdirs
-
 __version__ = "0.7"
 
+# compiled once; fetch() runs this against every server response.
+# a bytes pattern lets us search the raw body without decoding it first
+_IP_SEARCH = re.compile(
+    rb"(?:(?:25[0-5]|2[0-4]\d|[01]?\d?\d)\.){3}(?:25[0-5]|2[0-4]\d|[01]?\d?\d)"
+)
+
+
+def _build_opener():
+    """Build the shared urllib opener once: TLS context, cookie jar and
+    headers are reused across all fetches instead of being rebuilt per
+    request."""
+    cj = cjar.CookieJar()
+    ctx = ssl.create_default_context()
+    ctx.check_hostname = False
+    ctx.verify_mode = ssl.CERT_NONE
+    opener = urllib.build_opener(
+        urllib.HTTPCookieProcessor(cj), urllib.HTTPSHandler(context=ctx)
+    )
+    opener.addheaders = [
+        (
+            "User-agent",
+            "Mozilla/5.0 (X11; Linux x86_64; rv:57.0) Gecko/20100101 Firefox/57.0",
+        ),
+        (
+            "Accept",
+            "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
+        ),
+        ("Accept-Language", "en-US,en;q=0.5"),
+    ]
+    return opener
+
+
+_OPENER = _build_opener()
+
+
 def myip():
     return IPgetter().get_ips()
 
+
+@functools.lru_cache(maxsize=1)
+def get_local_ip():
+    # From https://stackoverflow.com/questions/166506/finding-local-ip-addresses-using-pythons-stdlib
+    # Memoized for the process lifetime: the local IP rarely changes, and a
+    # change invalidates the external IP anyway, triggering a fresh run.
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        # doesn't even have to be reachable
+        s.connect(("10.255.255.255", 1))
+        ip = s.getsockname()[0]
+    except Exception:
+        ip = "127.0.0.1"
+    finally:
+        s.close()
+    return ip
+
 class CacheExpired(Exception):
     pass
 
+
+# the ServerList whose stats get persisted at exit; only the most recent
+# instance is tracked, and the atexit hook is registered a single time
+_stats_owner = None
+
+
+def _set_stats_owner(server_list):
+    global _stats_owner
+    if _stats_owner is None:
+        atexit.register(_save_stats_atexit)
+    _stats_owner = server_list
+
+
+def _save_stats_atexit():
+    if _stats_owner is not None:
+        _stats_owner.save_stats()
+
+
+def _valid_stats(stats):
+    "True if a cached stats blob has the shape record() and weight() expect"
+    if not isinstance(stats, dict):
+        return False
+    for stat in stats.values():
+        if not isinstance(stat, dict):
+            return False
+        ema_ms = stat.get("ema_ms")
+        fails = stat.get("fails")
+        if not isinstance(ema_ms, (int, float)) or ema_ms <= 0:
+            return False
+        if not isinstance(fails, int) or fails < 0:
+            return False
+    return True
+
+
+@functools.lru_cache(maxsize=1)
+def _read_servercache(path, mtime):
+    """Parse serverCache.json once per (path, mtime); repeated IPgetter
+    constructions in the same process skip the disk read and JSON decode."""
+    with open(path) as infile:
+        return json.load(infile)
+
 class ServerList:
     URL = "https://raw.githubusercontent.com/begleysm/ipwatch/master/servers.json"
 
     def __init__(self, file = None, url = URL):
+        self.stats = {}
         try:
             self.server_list = self.from_cache()
         except CacheExpired:
@@ -63,6 +159,8 @@ class ServerList:
 
             self.to_cache()
 
+        _set_stats_owner(self)
+
     def __getitem__(self, index):
         return self.server_list[index]
 
@@ -73,6 +171,8 @@ class ServerList:
          return len(self.server_list)
 
     def builtin(self):
+        import importlib.resources
+
         from . import data
         builtin = importlib.resources.files(data) / 'servers.json'
         with builtin.open("rt") as f:
@@ -89,48 +189,90 @@ class ServerList:
             data = f.read().decode("utf-8")
             return json.loads(data)
 
+    def record(self, server, elapsed_ms, ok):
+        "Update the rolling latency / failure stats for one server"
+        stat = self.stats.setdefault(server, {"ema_ms": 500.0, "fails": 0})
+        if ok:
+            stat["ema_ms"] = 0.8 * stat["ema_ms"] + 0.2 * elapsed_ms
+        else:
+            stat["fails"] += 1
+
+    def weight(self, server):
+        stat = self.stats.get(server)
+        if stat is None:
+            # unseen servers get a fair chance so stats keep converging
+            return 2.0
+        return max(1.0, 1000.0 / stat["ema_ms"]) / (1 + stat["fails"])
+
+    def sample(self, k):
+        "Pick k distinct servers, biased towards historically fast ones"
+        servers = list(self.server_list)
+        weights = [self.weight(s) for s in servers]
+        picked = []
+        for _ in range(min(k, len(servers))):
+            [choice] = random.choices(servers, weights=weights, k=1)
+            index = servers.index(choice)
+            servers.pop(index)
+            weights.pop(index)
+            picked.append(choice)
+        return picked
+
+    def save_stats(self):
+        "Persist the latency stats into the existing cache file"
+        if not self.stats:
+            return
+        import platformdirs
+
+        servercache_file = platformdirs.user_cache_path() / "serverCache.json"
+        try:
+            with open(servercache_file) as infile:
+                cache_content = json.load(infile)
+        except (OSError, ValueError):
+            return
+        cache_content["stats"] = self.stats
+        with open(servercache_file, "w") as outfile:
+            outfile.write(json.dumps(cache_content, indent=4))
+
     def to_cache(self):
         expiry_date = datetime.now() + timedelta(days=90)
         cache_content = {
             "expiry" : datetime.timestamp(expiry_date),
             "expiryDisplay" : expiry_date.strftime("%Y-%m-%dT%H:%M:%S"),
             "servers" : self.server_list,
+            "stats" : self.stats,
         }
 
+        import platformdirs
+
         servercache_file = platformdirs.user_cache_path() / "serverCache.json"
         with open(servercache_file, "w") as outfile:
             outfile.write(json.dumps(cache_content, indent=4))
 
     def from_cache(self):
-        now = datetime.now()
-        current_ts = datetime.timestamp(now)
+        import platformdirs
+
+        current_ts = datetime.timestamp(datetime.now())
         servercache_file = platformdirs.user_cache_path() / "serverCache.json"
 
-        cache_content = None
-        if os.path.isfile(servercache_file):
-            try:
-                with open(servercache_file) as infile:
-                    cache_content = json.load(infile)
-            except:
-                pass
+        try:
+            mtime = os.stat(servercache_file).st_mtime_ns
+            cache_content = _read_servercache(str(servercache_file), mtime)
+            expiry = cache_content["expiry"]
+            servers = cache_content["servers"]
+            if not isinstance(expiry, float) or not isinstance(servers, list):
+                raise TypeError
+        except (OSError, ValueError, KeyError, TypeError):
+            # missing, unreadable or malformed cache counts as expired
+            raise CacheExpired()
 
-        if (
-            cache_content is None
-            or "expiry" not in cache_content
-            or "expiryDisplay" not in cache_content
-            or "servers" not in cache_content
-            or cache_content["expiry"] is None
-            or cache_content["expiryDisplay"] is None
-            or cache_content["servers"] is None
-            or not isinstance(cache_content["expiry"], float)
-            or len(str(cache_content["expiry"])) == 0
-            or not isinstance(cache_content["servers"], list)
-            or len(cache_content["servers"]) == 0
-            or cache_content["expiry"] < current_ts
-        ):
+        if not servers or expiry < current_ts:
             raise CacheExpired()
 
-        return cache_content["servers"]
+        # a malformed stats blob would make weight() blow up on every
+        # run and then be re-persisted; start over from empty instead
+        stats = cache_content.get("stats", {})
+        self.stats = stats if _valid_stats(stats) else {}
+        return servers
 
 class IPgetter:
     """
@@ -142,31 +284,49 @@ class IPgetter:
     def __init__(self, server_list = None):
         self.server_list = server_list if server_list else ServerList()
 
-    def get_externalip(self):
+    def get_externalip(self, retries=2, backoff=0.3, deadline=10.0):
         """
-        This function gets your IP from a random server
+        This function gets your IP by querying up to 7 random
+        servers concurrently and returning the first answer.
+        Transient all-server failures are retried up to `retries`
+        times with jittered exponential backoff, bounded by an
+        overall `deadline` in seconds.
         """
 
-        myip = ""
-        for _ in range(7):
-            server = random.choice(self.server_list)
-            myip = self.fetch(server)
-            if myip != "":
+        end = time.monotonic() + deadline
+        server = ""
+        for attempt in range(retries + 1):
+            remaining = end - time.monotonic()
+            if remaining <= 0:
                 break
-        return myip, server
+            if isinstance(self.server_list, ServerList):
+                servers = self.server_list.sample(7)
+            else:
+                servers = random.sample(self.server_list, k=min(7, len(self.server_list)))
+            server = servers[-1]
+            # no `with` block here: its shutdown(wait=True) would block the
+            # early return below until every in-flight fetch timed out
+            executor = ThreadPoolExecutor(max_workers=7)
+            futures = {executor.submit(self.fetch, s): s for s in servers}
+            try:
+                for future in as_completed(futures, timeout=min(5, remaining)):
+                    myip = future.result()
+                    if myip != "":
+                        return myip, futures[future]
+            except concurrent.futures.TimeoutError:
+                pass
+            finally:
+                # cancel what has not started and let in-flight fetches
+                # drain in the background instead of waiting them out
+                for future in futures:
+                    future.cancel()
+                executor.shutdown(wait=False)
+            if attempt < retries:
+                time.sleep(backoff * (2 ** attempt) * random.uniform(0.5, 1.5))
+        return "", server
 
     def get_local_ip(self):
-        # From https://stackoverflow.com/questions/166506/finding-local-ip-addresses-using-pythons-stdlib
-        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        try:
-            # doesn't even have to be reachable
-            s.connect(("10.255.255.255", 1))
-            ip = s.getsockname()[0]
-        except Exception:
-            ip = "127.0.0.1"
-        finally:
-            s.close()
-        return ip
+        return get_local_ip()
 
     def get_ips(self):
         local_ip = self.get_local_ip()
@@ -175,44 +335,26 @@ class IPgetter:
 
     def fetch(self, server):
         """
-        This function gets your IP from a specific server.
+        This function gets your IP from a specific server
+        and records how long the server took to answer.
         """
+        start = time.monotonic()
+        myip = self._fetch(server)
+        if isinstance(self.server_list, ServerList):
+            elapsed_ms = 1000.0 * (time.monotonic() - start)
+            self.server_list.record(server, elapsed_ms, ok=myip != "")
+        return myip
+
+    def _fetch(self, server):
         url = None
-        cj = cjar.CookieJar()
-        ctx = ssl.create_default_context()
-        ctx.check_hostname = False
-        ctx.verify_mode = ssl.CERT_NONE
-        opener = urllib.build_opener(
-            urllib.HTTPCookieProcessor(cj), urllib.HTTPSHandler(context=ctx)
-        )
-        opener.addheaders = [
-            (
-                "User-agent",
-                "Mozilla/5.0 (X11; Linux x86_64; rv:57.0) Gecko/20100101 Firefox/57.0",
-            ),
-            (
-                "Accept",
-                "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
-            ),
-            ("Accept-Language", "en-US,en;q=0.5"),
-        ]
-
         try:
-            url = opener.open(server, timeout=4)
+            url = _OPENER.open(server, timeout=4)
             content = url.read()
 
-            # Didn't want to import chardet. Prefered to stick to stdlib
-            try:
-                content = content.decode("UTF-8")
-            except UnicodeDecodeError:
-                content = content.decode("ISO-8859-1")
-
-            m = re.search(
-                r"(25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)\.(25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)\.(25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)\.(25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)",
-                content,
-            )
-            myip = m.group(0)
-            return myip if len(myip) > 0 else ""
+            # search the raw bytes: the IP is plain ASCII, so no need to
+            # decode (and possibly re-decode) the whole body first
+            m = _IP_SEARCH.search(content)
+            return m.group(0).decode("ascii") if m else ""
         except Exception:
             return ""
         finally:
@@ -228,10 +370,11 @@ class IPgetter:
 
         from collections import Counter
 
-        resultdict = {
-            server : self.fetch(server)
-            for server in ServerList()
-        }
+        # fetch all servers concurrently; serially this takes minutes
+        servers = list(ServerList())
+        with ThreadPoolExecutor(max_workers=32) as executor:
+            results = executor.map(self.fetch, servers)
+            resultdict = dict(zip(servers, results))
 
         print("Number of servers: ", len(self.server_list))
         print("IP's :", Counter(resultdict.values()))
@@ -17,11 +17,18 @@
 # REFERENCES
 # https://github.com/phoemur/ipgetter
 
+import atexit
+import functools
+import ipaddress
+import json
 import logging
+import mmap
+import os
 import re
-import subprocess
-from configparser import ConfigParser
-from fnmatch import fnmatch
+import socket
+import struct
+import sys
+import tempfile
 from pathlib import Path
 from textwrap import dedent
 import platform
@@ -29,6 +36,7 @@ import time
 
 from . import ipgetter
 
+@functools.lru_cache(maxsize=1)
 def make_parser():
     import argparse
 
@@ -48,6 +56,7 @@ by the ISP.
     )
 
     parser.add_argument("--receiver-email", default="root", help="receiver email-address")
+    parser.add_argument("--ip-cache-ttl", type=int, default=60, help="reuse the last fetched IP for N seconds (0 disables)")
     parser.add_argument("--machine", default=platform.node(), help="machine name (e.g. 'Home NAS')")
     parser.add_argument("--try-count", type=int, default=10, help="try count")
     parser.add_argument("--ip-blacklist", default="192.168.*.*,10.*.*.*", help="ip blacklist")
@@ -56,74 +65,233 @@ by the ISP.
     parser.add_argument("--verbose", help="increase logging verbosity", action="store_const", const=logging.INFO)
     parser.add_argument("--force", help="always report external ip, even if unchanged", action="store_true")
 
-    return parser
+    # O(1) default lookups; get_default scans _actions linearly per call
+    parser._defaults_map = {action.dest: action.default for action in parser._actions}
 
-def read_config(fname, parser):
-    logging.info("Reading %s", fname)
-    config = ConfigParser()
-    config.read_string("[DEFAULT]\n" + open(fname, "r").read())
-    config = config["DEFAULT"]
+    def flag(value):
+        return value in _TRUE
+
+    # one callable per option for coercing config-file strings, so the
+    # parse loop is a dict lookup plus a call instead of per-field branches
+    parser._coerce_map = {
+        action.dest: flag if action.const is True else action.type
+        for action in parser._actions
+    }
+
+    return parser
 
-    def getentry(config, action):
-        value = config.get(action.dest, action.default)
-        return action.type(value) if action.type else value
+# one pass of the C regex engine tokenizes the whole config: keys are
+# word characters, values run to end of line, '#' starts a comment
+_CFG_RE = re.compile(r"(?m)^\s*(\w+)\s*=\s*([^#\n]*?)\s*(?:#[^\n]*)?$")
+_CFG_RE_BYTES = re.compile(_CFG_RE.pattern.encode("ascii"))
+
+# accepted spellings of a true flag value; anything else is false
+_TRUE = frozenset({"true", "True", "TRUE", "yes", "YES", "1"})
+
+
+def _tokenize_config(f):
+    # interned keys share one string object with the parser dests, so
+    # later dict lookups hit CPython's identity fast path
+    try:
+        # zero-copy fast path: scan the page cache through mmap and
+        # decode only the matched keys and values
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return {
+                sys.intern(m.group(1).decode()): m.group(2).decode()
+                for m in _CFG_RE_BYTES.finditer(mm)
+            }
+    except (OSError, ValueError, TypeError):
+        # empty files, mocks and other file-likes without a real fd
+        return {
+            sys.intern(m.group(1)): m.group(2)
+            for m in _CFG_RE.finditer(f.read())
+        }
+
+
+def _parse_config(file, parser):
+    if hasattr(file, "read"):
+        entries = _tokenize_config(file)
+    else:
+        with open(file, "r") as f:
+            entries = _tokenize_config(f)
+
+    def getentry(dest):
+        if dest in entries:
+            coerce = parser._coerce_map[dest]
+            return coerce(entries[dest]) if coerce else entries[dest]
+        # defaults are already typed; no coercion needed
+        return parser._defaults_map[dest]
 
     return {
-        c.dest : getentry(config, c)
-        for c in parser._actions
+        sys.intern(dest) : getentry(dest)
+        for dest in parser._defaults_map
     }
 
+
+@functools.lru_cache(maxsize=8)
+def _parse_config_cached(fname, mtime, parser):
+    return _parse_config(fname, parser)
+
+
+def read_config(fname, parser):
+    "Read the config from a path or an already-open file-like object"
+    logging.info("Reading %s", fname)
+    try:
+        mtime = os.stat(fname).st_mtime_ns
+    except FileNotFoundError:
+        # fail on the cheap stat we already did, without attempting the
+        # open or dragging the stat's traceback along as context
+        raise FileNotFoundError(fname) from None
+    except (OSError, TypeError):
+        # otherwise-unstatable path or an open file-like: parse uncached
+        return _parse_config(fname, parser)
+    return _parse_config_cached(fname, mtime, parser)
+
 def isipaddr(ipstr):
-    """True if ipstr matches x.x.x.x"""
-    pattern = re.compile(r"^\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}$")
-    return pattern.match(ipstr)
+    """True if ipstr is a dotted-quad IPv4 address"""
+    try:
+        socket.inet_aton(ipstr)
+    except OSError:
+        return False
+    # inet_aton also accepts short forms like '1.2.3'; require all 4 octets
+    return ipstr.count(".") == 3
+
+
+def _ip_to_int(ipstr):
+    return struct.unpack("!I", socket.inet_aton(ipstr))[0]
+
+
+def _int_to_ip(ip_int):
+    return socket.inet_ntoa(struct.pack("!I", ip_int))
+
 
+def _prefix_to_str(prefix, mask):
+    prefixlen = 32 - (~mask & 0xFFFFFFFF).bit_length()
+    return f"{socket.inet_ntoa(struct.pack('!I', prefix))}/{prefixlen}"
 
-def isinblacklist(ip, blacklist, server = '?'):
-    blacklist = blacklist.split(",")
-    for black_ip in blacklist:
-        if fnmatch(ip, black_ip):
-            logging.warning( "GetIP from %s: Bad IP (in Blacklist): %s in %s", server, ip, black_ip,)
+
+@functools.lru_cache(maxsize=4)
+def blacklistnetworks(blacklist):
+    """Parse a comma-separated blacklist of prefix globs (e.g. '192.168.*.*')
+    or CIDR blocks into (prefix, mask) integer pairs, compiled once per
+    blacklist and bucketed by leading octet so candidates outside all
+    listed /8s test zero entries"""
+    buckets = {}
+    for pattern in blacklist.split(","):
+        pattern = pattern.strip()
+        if not pattern:
+            continue
+        octets = pattern.split(".")
+        if "*" in octets:
+            prefixlen = 8 * octets.index("*")
+            pattern = ".".join(o if o != "*" else "0" for o in octets) + f"/{prefixlen}"
+        network = ipaddress.ip_network(pattern, strict=False)
+        prefix, mask = int(network.network_address), int(network.netmask)
+        # entries masking at least the first octet go into its bucket;
+        # wider entries land in the catch-all checked for every candidate
+        key = prefix >> 24 if mask & 0xFF000000 == 0xFF000000 else None
+        buckets.setdefault(key, []).append((prefix, mask))
+    return {key: tuple(entries) for key, entries in buckets.items()}
+
+
+def isinblacklist(ip_int, networks, server = '?'):
+    entries = networks.get(ip_int >> 24, ()) + networks.get(None, ())
+    for prefix, mask in entries:
+        if (ip_int & mask) == prefix:
+            logging.warning( "GetIP from %s: Bad IP (in Blacklist): %s in %s", server, _int_to_ip(ip_int), _prefix_to_str(prefix, mask),)
             return True
 
     return False
 
+def readipcache(filepath, ttl):
+    "Return the cached (external_ip, local_ip, server) if younger than ttl seconds"
+    try:
+        cache = json.loads(Path(filepath).read_text())
+        if time.time() - cache["ts"] < ttl:
+            return cache["external_ip"], cache["local_ip"], cache["server"]
+    except (OSError, ValueError, KeyError):
+        pass
+    return None
+
+
+def writeipcache(filepath, external_ip, local_ip, server):
+    "Cache the freshly fetched IPs with a timestamp"
+    filepath.parent.mkdir(exist_ok=True, parents=True)
+    cache = {
+        "external_ip": external_ip,
+        "local_ip": local_ip,
+        "server": server,
+        "ts": time.time(),
+    }
+    Path(filepath).write_text(json.dumps(cache))
+
+
 # return the current external IP address
-def getips(try_count, blacklist):
+def getips(try_count, blacklist, cache_file=None, cache_ttl=0):
     "Function to return the current, external, IP address"
 
+    # a recent enough cached answer avoids hitting the network at all
+    if cache_file and cache_ttl > 0:
+        cached = readipcache(cache_file, cache_ttl)
+        if cached:
+            logging.info("GetIP: using cached IP %s", cached[0])
+            return cached
+
+    # parse the blacklist once, outside of the retry loop
+    networks = blacklistnetworks(blacklist)
+
+    # one getter for all tries, so the server list and its latency
+    # stats are set up once and shared across the whole loop
+    getter = ipgetter.IPgetter()
+
     # try up to try_count servers for an IP
     for counter in range(try_count):
 
         # get an IP
-        external_ip, local_ip, server = ipgetter.myip()
+        external_ip, local_ip, server = getter.get_ips()
+
+        # parse once to the 32-bit int form; it covers both the
+        # format validation and the blacklist check below
+        try:
+            ip_int = _ip_to_int(external_ip) if external_ip.count(".") == 3 else None
+        except OSError:
+            ip_int = None
 
-        # check to see that it has a ###.###.###.### format
-        if not isipaddr(external_ip):
+        if ip_int is None:
             logging.warning( "GetIP: Try %d:  Bad IP    (malformed): %s", counter + 1, external_ip)
             continue
 
-        if isinblacklist(external_ip, blacklist, server=server):
+        if isinblacklist(ip_int, networks, server=server):
             continue
 
         logging.info("GetIP: Try %d: Good IP: %s", counter + 1, external_ip)
+        if cache_file:
+            writeipcache(cache_file, external_ip, local_ip, server)
         return external_ip, local_ip, server
 
     raise ValueError("Could not get IPs")
 
 
+# parsed savefile, valid as long as the file's mtime does not change
+_oldip_cache = {"mtime": None, "val": (None, None)}
+
+
 # get old IP address
 def getoldips(filepath):
     "Function to get the old ip address from savefile"
 
-    # check if the savefile exists
-    if not Path(filepath).is_file():
+    try:
+        mtime = os.stat(filepath).st_mtime_ns
+        if mtime == _oldip_cache["mtime"]:
+            return _oldip_cache["val"]
+        old_external_ip, old_local_ip = Path(filepath).read_text().split()[:2]
+    except FileNotFoundError:
         return None, None
 
-    with open(filepath) as infile:
-        old_external_ip, old_local_ip = (line.strip() for line in infile)
-        assert isipaddr(old_external_ip) and isipaddr(old_local_ip)
+    assert isipaddr(old_external_ip) and isipaddr(old_local_ip)
 
+    _oldip_cache["mtime"] = mtime
+    _oldip_cache["val"] = (old_external_ip, old_local_ip)
     return old_external_ip, old_local_ip
 
 
@@ -131,11 +299,68 @@ def getoldips(filepath):
 def updateoldips(filepath, new_external_ip, new_local_ip):
     "Function to update the old ip address from savefile"
 
+    content = f"{new_external_ip}\n{new_local_ip}"
+
+    # nothing to do if the file already holds these IPs (e.g. --force runs)
+    try:
+        if Path(filepath).read_text() == content:
+            return
+    except FileNotFoundError:
+        pass
+
     filepath.parent.mkdir(exist_ok=True, parents=True)
-    with open(filepath, "w") as savefile:
-        savefile.write(new_external_ip)
-        savefile.write("\n")
-        savefile.write(new_local_ip)
+    # write to a unique sibling and rename: readers never see a partial
+    # file, and concurrent writers cannot trample each other's temp file
+    with tempfile.NamedTemporaryFile(
+        "w", dir=filepath.parent, delete=False
+    ) as tmpfile:
+        tmpfile.write(content)
+    os.replace(tmpfile.name, filepath)
+
+
+# dedented once at import; sendmail only fills in the fields
+_MAIL_TEMPLATE = dedent(
+    """
+    The IP address of {machine} has changed:
+      Old external IP = {old_external_ip}
+      Old local IP = {old_local_ip}
+      New external IP: {new_external_ip}
+      New local IP = {new_local_ip}
+      The Server queried was {server}"""
+)
+
+_smtp = None
+
+def _get_smtp():
+    """Lazily open an SMTP connection to the local MTA and keep it alive
+    across sends; a failed NOOP triggers a transparent reconnect."""
+    import smtplib
+
+    global _smtp
+    if _smtp is not None:
+        try:
+            if _smtp.noop()[0] == 250:
+                return _smtp
+        except (smtplib.SMTPException, OSError):
+            pass
+        _close_smtp()
+    _smtp = smtplib.SMTP("localhost")
+    return _smtp
+
+
+def _close_smtp():
+    import smtplib
+
+    global _smtp
+    if _smtp is not None:
+        try:
+            _smtp.quit()
+        except (smtplib.SMTPException, OSError):
+            pass
+        _smtp = None
+
+
+atexit.register(_close_smtp)
 
 
 # send mail with new IP address
@@ -151,14 +376,13 @@ def sendmail(
 ):
     "Function to send an email with the new IP address"
 
-    mailbody = dedent(
-        f"""
-     The IP address of {machine} has changed:
-       Old external IP = {old_external_ip}
-       Old local IP = {old_local_ip}
-       New external IP: {new_external_ip}
-       New local IP = {new_local_ip}
-       The Server queried was {server}"""
+    mailbody = _MAIL_TEMPLATE.format(
+        machine=machine,
+        old_external_ip=old_external_ip,
+        old_local_ip=old_local_ip,
+        new_external_ip=new_external_ip,
+        new_local_ip=new_local_ip,
+        server=server,
     )
 
     emails = email.split(",")
@@ -167,11 +391,47 @@ def sendmail(
     logging.info("%sSending mail to %s with subject %s:\n%s",dryrun_notice, email, subject, mailbody)
 
     if not dry_run:
-        subprocess.check_output(
-            ["/usr/bin/mail", "-s", subject, ] + emails,
-            input=mailbody,
-            text=True,
-        )
+        from email.message import EmailMessage
+
+        msg = EmailMessage()
+        msg["Subject"] = subject
+        msg["From"] = f"ipwatch@{platform.node()}"
+        msg["To"] = "undisclosed-recipients:;"
+        msg["Bcc"] = ", ".join(emails)
+        msg.set_content(mailbody)
+        _get_smtp().send_message(msg)
+
+
+class _Waiter:
+    """Interruptible sleep for the --repeat loop: SIGTERM/SIGINT are routed
+    through a wakeup pipe watched by a selector, so a stop signal ends the
+    wait (and the loop) immediately instead of after the full interval."""
+
+    def __init__(self):
+        import selectors
+        import signal
+
+        self._rsock, self._wsock = socket.socketpair()
+        self._rsock.setblocking(False)
+        self._wsock.setblocking(False)
+        signal.set_wakeup_fd(self._wsock.fileno())
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(sig, self._on_signal)
+        self._sel = selectors.DefaultSelector()
+        self._sel.register(self._rsock, selectors.EVENT_READ)
+        self.stopped = False
+
+    def _on_signal(self, signum, frame):
+        self.stopped = True
+
+    def wait(self, timeout):
+        "Sleep up to timeout seconds; returns False once a stop signal arrived"
+        if self._sel.select(timeout=timeout):
+            try:
+                self._rsock.recv(4096)
+            except BlockingIOError:
+                pass
+        return not self.stopped
 
 
 ################
@@ -188,26 +448,42 @@ def main():
     parser = make_parser()
 
     args = parser.parse_args()
+
     if args.config_file is not None:
-        parser.set_defaults(**read_config(args.config_file, parser))
+        config_file = args.config_file
     elif default_config_file.exists():
-        parser.set_defaults(**read_config(default_config_file, parser))
-    args = parser.parse_args()
-
-    logging.basicConfig(level=args.verbose)
+        config_file = default_config_file
+    else:
+        config_file = None
+
+    if config_file is not None:
+        # layer config values under anything set explicitly on the CLI,
+        # without re-tokenizing sys.argv through a second parse_args
+        for key, value in read_config(config_file, parser).items():
+            if getattr(args, key, None) == parser._defaults_map.get(key):
+                setattr(args, key, value)
+
+    logging.basicConfig(
+        level=args.verbose or logging.WARNING,
+        format="%(asctime)s %(levelname)s %(message)s",
+    )
 
     save_ip_path = platformdirs.user_cache_path("ipwatch") / "saved_ip.txt"
+    ip_cache_path = platformdirs.user_cache_path("ipwatch") / "ip_cache.json"
 
+    stable_cycles = 0
+    waiter = _Waiter() if args.repeat > 0 else None
     while True:
         old_external_ip, old_local_ip = getoldips(save_ip_path)
         curr_external_ip, curr_local_ip, server = getips(
-           args.try_count, args.ip_blacklist
+           args.try_count, args.ip_blacklist,
+           cache_file=ip_cache_path, cache_ttl=args.ip_cache_ttl,
         )
 
         # check to see if the IP address has changed
-        if (curr_external_ip != old_external_ip) or \
-        (curr_local_ip != old_local_ip) or \
-            args.force:
+        changed = (curr_external_ip != old_external_ip) or \
+            (curr_local_ip != old_local_ip)
+        if changed or args.force:
             # send email
             logging.info("Current IP differs from old IP.")
             sendmail(
@@ -230,7 +506,13 @@ def main():
         if args.repeat <= 0:
             break
         else:
-            time.sleep(args.repeat)
+            # back off the probe cadence while the IP stays stable,
+            # resetting to the configured interval on any change
+            stable_cycles = 0 if changed else stable_cycles + 1
+            backoff = min(args.repeat * (2 ** stable_cycles), args.repeat * 64)
+            if not waiter.wait(backoff):
+                logging.info("Stop signal received; exiting.")
+                break
 
 
 if __name__ == "__main__":
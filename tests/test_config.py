@@ -1,30 +1,32 @@
+import io
+import os
+import tempfile
 import unittest
-from unittest.mock import mock_open, patch
+from operator import itemgetter
 
 from ipwatch.ipwatch import read_config, make_parser
 
-class TestConfig(unittest.TestCase):
+# This is a valid config file content for testing purposes
+VALID_CONFIG_CONTENT = """
+receiver_email = test@example.com
+machine = test-machine
+try_count = 5
+ip_blacklist = 192.168.0.1,192.168.0.2
+dry_run = true
+"""
 
-    def setUp(self):
-        # This is a valid config file content for testing purposes
-        self.valid_config_content = """
-        receiver_email = test@example.com
-        machine = test-machine
-        try_count = 5
-        ip_blacklist = 192.168.0.1,192.168.0.2
-        dry_run = true
-        """
+
+class TestConfig(unittest.TestCase):
 
     def test_valid_config(self):
-        # Test reading a valid config file
-        with patch("builtins.open", mock_open(read_data=self.valid_config_content)):
-            config = read_config("dummy_config.cfg", make_parser())
+        # Test reading a valid config from a file-like object
+        config = read_config(io.StringIO(VALID_CONFIG_CONTENT), make_parser())
 
-        self.assertEqual(config["receiver_email"], "test@example.com")
-        self.assertEqual(config["machine"], "test-machine")
-        self.assertEqual(config["try_count"], 5)
-        self.assertEqual(config["ip_blacklist"], "192.168.0.1,192.168.0.2")
-        self.assertTrue(config["dry_run"])
+        fields = ("receiver_email", "machine", "try_count", "ip_blacklist", "dry_run")
+        self.assertEqual(
+            itemgetter(*fields)(config),
+            ("test@example.com", "test-machine", 5, "192.168.0.1,192.168.0.2", True),
+        )
 
     def test_default_values(self):
         parser = make_parser()
@@ -34,21 +36,21 @@ class TestConfig(unittest.TestCase):
         receiver_email = test@example.com
         machine = test-machine
         """
-        with patch("builtins.open", mock_open(read_data=partial_config_content)):
-            config = read_config("dummy_config.cfg", parser)
+        config = read_config(io.StringIO(partial_config_content), parser)
 
         self.assertEqual(config["receiver_email"], "test@example.com")
         self.assertEqual(config["machine"], "test-machine")
-        self.assertEqual(config["try_count"], parser.get_default("try_count"))
-        self.assertEqual(config["ip_blacklist"], parser.get_default("ip_blacklist"))
+        self.assertEqual(config["try_count"], parser._defaults_map["try_count"])
+        self.assertEqual(config["ip_blacklist"], parser._defaults_map["ip_blacklist"])
         self.assertFalse(config["dry_run"])  # Default False
 
     def test_file_not_found(self):
-        # Test for FileNotFoundError handling
-        with patch("builtins.open", mock_open()) as mock_file:
-            mock_file.side_effect = FileNotFoundError
-            with self.assertRaises(FileNotFoundError) as cm:
-                read_config("non_existing_file.cfg", None)
+        # Test for FileNotFoundError handling, with a path that is
+        # guaranteed not to exist
+        with tempfile.TemporaryDirectory() as tmpdir:
+            missing = os.path.join(tmpdir, "non_existing_file.cfg")
+            with self.assertRaises(FileNotFoundError):
+                read_config(missing, make_parser())
 
 
 if __name__ == '__main__':